@@ -1,38 +1,60 @@
 from __future__ import annotations
 
-import sys
-from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
-if sys.version_info >= (3, 12):
-    from typing import override as typing_override
-else:  # pragma: no cover
-    from typing_extensions import (
-        override as typing_override,  # pyright: ignore[reportUnreachable]
-    )
 
-override = typing_override
+DJANGO_LITESTREAM_SETTINGS_NAME = "LITESTREAM"
 
+_DEFAULTS: dict[str, object] = {
+    "config_file": "/etc/litestream.yml",
+    "path_prefix": None,
+    "bin_path": "litestream",
+    "dbs": None,
+    "extend_dbs": None,
+    "logging": None,
+    "addr": None,
+}
 
-DJANGO_LITESTREAM_SETTINGS_NAME = "LITESTREAM"
+_LITESTREAM_KEYS = frozenset({"addr", "logging"})
 
 
-@dataclass(frozen=True)
 class AppSettings:
-    config_file: Path | str = "/etc/litestream.yml"
-    path_prefix: str | None = None
-    bin_path: Path | str = "litestream"
-    dbs: list[dict[str, str]] = None
-    extend_dbs: list[dict[str, str]] = None
-    logging: dict[str, str] = None
-    addr: str | None = None
-
-    @override
-    def __getattribute__(self, __name: str) -> object:
-        user_settings = getattr(settings, DJANGO_LITESTREAM_SETTINGS_NAME, {})
-        return user_settings.get(__name, super().__getattribute__(__name))  # pyright: ignore[reportAny]
+    config_file: Path | str
+    path_prefix: str | None
+    bin_path: Path | str
+    dbs: list[dict[str, str]] | None
+    extend_dbs: list[dict[str, str]] | None
+    logging: dict[str, str] | None
+    addr: str | None
+
+    @cached_property
+    def user_settings(self) -> dict:
+        return getattr(settings, DJANGO_LITESTREAM_SETTINGS_NAME, {})
+
+    @cached_property
+    def litestream_settings(self) -> dict:
+        """Global litestream configuration options (``addr``, ``logging``) set by the user."""
+        return {key: value for key, value in self.user_settings.items() if key in _LITESTREAM_KEYS and value}
+
+    def __getattr__(self, name: str) -> object:
+        # Only called when normal attribute lookup fails, i.e. for the settings above.
+        try:
+            default = _DEFAULTS[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        return self.user_settings.get(name, default)
 
 
 app_settings = AppSettings()
+
+
+@receiver(setting_changed)
+def _reload_app_settings(*, setting: str, **kwargs) -> None:
+    if setting == DJANGO_LITESTREAM_SETTINGS_NAME:
+        for name in ("user_settings", "litestream_settings"):
+            app_settings.__dict__.pop(name, None)
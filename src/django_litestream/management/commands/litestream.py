@@ -1,21 +1,16 @@
 from __future__ import annotations
 
-import datetime as dt
-import secrets
-import sqlite3
+import os
 import subprocess
-import tempfile
-import time
-from itertools import chain
+from functools import lru_cache
 from pathlib import Path
+from pathlib import PurePath
 from typing import TYPE_CHECKING
 
 from django.conf import settings
 from django.core.management import BaseCommand
-from rich.progress import Progress
-from rich.progress import SpinnerColumn
-from rich.progress import TextColumn
-from yaml import dump
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 from django_litestream.conf import app_settings
 
@@ -49,6 +44,18 @@ NO_EXPAND_ENV_ARG = {
 }
 
 
+# seconds to wait before each restore attempt of the verify subcommand, 10 seconds at most
+VERIFY_RETRY_DELAYS = (1, 2, 3, 4)
+
+S3_REPLICA = {
+    "type": "s3",
+    "bucket": "$LITESTREAM_REPLICA_BUCKET",
+    "path": None,
+    "access-key-id": "$LITESTREAM_ACCESS_KEY_ID",
+    "secret-access-key": "$LITESTREAM_SECRET_ACCESS_KEY",
+}
+
+
 def _get_replica_arg(subcommand: str) -> dict:
     return {
         "name": "-replica",
@@ -166,8 +173,23 @@ LITESTREAM_COMMANDS = {
 }
 
 
+def _compile_argument(args: dict) -> tuple[str, dict, str, bool]:
+    kwargs = args.copy()
+    name = kwargs.pop("name")
+    return name, kwargs, name.strip("-").replace("-", "_"), name.startswith("-")
+
+
+# (name, add_argument kwargs, options dest, is optional) for each argument, computed once at import
+COMPILED_ARGUMENTS = {
+    ls_cmd: [_compile_argument(args) for args in details["arguments"]]
+    for ls_cmd, details in LITESTREAM_COMMANDS.items()
+}
+
+
 class Command(BaseCommand):
     help = "Litestream is a tool for replicating SQLite databases."
+    # only replace the process with litestream when run from manage.py, not from call_command
+    _exec_binary = False
 
     def add_arguments(self, parser: ArgumentParser) -> None:
         subcommands = parser.add_subparsers(help="subcommands", dest="subcommand")
@@ -185,8 +207,8 @@ class Command(BaseCommand):
                 help=details["description"],
                 description=details["description"],
             )
-            for args in details["arguments"]:
-                _add_argument(parser, args)
+            for name, kwargs, _, _ in COMPILED_ARGUMENTS[ls_cmd]:
+                parser.add_argument(name, **kwargs)
 
         verify_cmd = subcommands.add_parser(
             name="verify",
@@ -196,12 +218,16 @@ class Command(BaseCommand):
         _add_argument(verify_cmd, DB_PATH_ARG)
         _add_argument(verify_cmd, CONFIG_ARG)
 
+    def run_from_argv(self, argv: list[str]) -> None:
+        self._exec_binary = True
+        super().run_from_argv(argv)
+
     def handle(self, *_, **options) -> None:
         if options["subcommand"] == "init":
             self.init(filepath=options["config"])
             self.stdout.write(self.style.SUCCESS("Litestream configuration file created"))
         elif options["subcommand"] == "version":
-            subprocess.run([app_settings.bin_path, "version"])
+            self.run_litestream(["version"])
         elif options["subcommand"] == "verify":
             exit_code, msg = self.verify(_db_location_from_alias(options["db_path"]), config=options["config"])
             style = self.style.ERROR if exit_code else self.style.SUCCESS
@@ -216,17 +242,28 @@ class Command(BaseCommand):
             if options["verbosity"] > 1:
                 self.stdout.write(f"Litestream bin: {app_settings.bin_path}")
                 self.stdout.write(f"Litestream args: {ls_args}")
+            self.run_litestream(ls_args)
+
+    def run_litestream(self, ls_args: list[str]) -> None:
+        cmd = [str(app_settings.bin_path), *ls_args]
+        if self._exec_binary and os.name == "posix":
+            # nothing left to do on our side, hand the process over to litestream so that it
+            # receives signals directly and its exit code becomes ours. execvp never returns,
+            # so run_from_argv's finally block (connections.close_all()) is skipped, the exec
+            # releases the process's database handles anyway.
+            self.stdout.flush()
+            self.stderr.flush()
+            os.execvp(cmd[0], cmd)
+        else:
             try:
-                subprocess.run([app_settings.bin_path, *ls_args], check=False)
+                subprocess.run(cmd, check=False)
             except KeyboardInterrupt:
                 self.stdout.write("Litestream command interrupted")
 
     def parse_args(self, subcommand: str, options: dict) -> list[str]:
         positionals = []
         optionals = []
-        for argument in LITESTREAM_COMMANDS[subcommand]["arguments"]:
-            arg_name = argument["name"]
-            dest = arg_name.strip("-").replace("-", "_")
+        for arg_name, _, dest, is_optional in COMPILED_ARGUMENTS[subcommand]:
             if dest not in options:
                 continue
             value = options[dest]
@@ -240,49 +277,50 @@ class Command(BaseCommand):
             if isinstance(value, list):
                 value = " ".join(value).strip()
 
-            if arg_name.startswith("-"):
+            if is_optional:
                 if is_bool:
                     optionals.append(arg_name)
                 else:
                     optionals.extend([arg_name, str(value)])
             else:
                 positionals.append(str(value))
-        return [subcommand, *list(chain(optionals)), *positionals]
+        return [subcommand, *optionals, *positionals]
 
     def init(self, filepath: Path):
-        dbs = app_settings.dbs if app_settings.dbs else []
-        config = {"dbs": dbs}
-        if app_settings.logging:
-            config["logging"] = app_settings.logging
-        if app_settings.addr:
-            config["addr"] = app_settings.addr
+        import yaml
+
+        with open(filepath, "w") as f:
+            yaml.dump(self.build_config(), f, Dumper=_get_yaml_dumper(), sort_keys=False)
+
+    def build_config(self) -> dict:
+        # copy so that extend_dbs never mutates the user's settings
+        dbs: list[dict] = list(app_settings.dbs or [])
         if not dbs:
-            for db_settings in settings.DATABASES.values():
-                if db_settings["ENGINE"] == "django.db.backends.sqlite3":
-                    location = str(db_settings["NAME"])
-                    path = Path(location).name
-                    if app_settings.path_prefix:
-                        path = str(Path(app_settings.path_prefix) / path)
-                    dbs.append(
-                        {
-                            "path": location,
-                            "replicas": [
-                                {
-                                    "type": "s3",
-                                    "bucket": "$LITESTREAM_REPLICA_BUCKET",
-                                    "path": path,
-                                    "access-key-id": "$LITESTREAM_ACCESS_KEY_ID",
-                                    "secret-access-key": "$LITESTREAM_SECRET_ACCESS_KEY",
-                                }
-                            ],
-                        }
-                    )
+            prefix = Path(app_settings.path_prefix) if app_settings.path_prefix else None
+            dbs = [
+                {
+                    "path": str(db_settings["NAME"]),
+                    "replicas": [{**S3_REPLICA, "path": _replica_path(db_settings["NAME"], prefix)}],
+                }
+                for db_settings in settings.DATABASES.values()
+                if db_settings["ENGINE"] == "django.db.backends.sqlite3"
+            ]
         if app_settings.extend_dbs:
             dbs.extend(app_settings.extend_dbs)
-        with open(filepath, "w") as f:
-            dump(config, f, sort_keys=False)
+        return {"dbs": dbs, **app_settings.litestream_settings}
 
     def verify(self, db_path: str | Path, config: str | Path) -> tuple[int, str]:
+        import datetime as dt
+        import secrets
+        import sqlite3
+        import tempfile
+        import time
+        from contextlib import closing
+
+        from rich.progress import Progress
+        from rich.progress import SpinnerColumn
+        from rich.progress import TextColumn
+
         with Progress(
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
@@ -302,38 +340,66 @@ class Command(BaseCommand):
                 )
                 db.commit()
 
-            time.sleep(10)
-
             with tempfile.TemporaryDirectory() as temp_dir:
-                temp_db_path = (Path(temp_dir) / db_path).with_suffix(".restored").name
-                result = subprocess.run(
-                    [
-                        app_settings.bin_path,
-                        "restore",
-                        "-config",
-                        config,
-                        "-o",
-                        temp_db_path,
-                        db_path,
-                    ],
-                    stdout=subprocess.PIPE,
-                )
-                if result.returncode != 0:
-                    return result.returncode, "Database restore failed"
-
-                with sqlite3.connect(temp_db_path) as db:
-                    cursor = db.cursor()
-                    cursor.execute(
-                        "SELECT code, created FROM _litestream_verification WHERE code = ? and created = ?",
-                        data,
+                temp_db_path = Path(temp_dir) / f"{Path(db_path).name}.restored"
+                # litestream syncs every second by default, check early and back off instead
+                # of always waiting for the worst case
+                for delay in VERIFY_RETRY_DELAYS:
+                    time.sleep(delay)
+                    # only keep one restored copy around, litestream won't overwrite it anyway
+                    temp_db_path.unlink(missing_ok=True)
+                    result = subprocess.run(
+                        [
+                            app_settings.bin_path,
+                            "restore",
+                            "-config",
+                            config,
+                            "-o",
+                            temp_db_path,
+                            db_path,
+                        ],
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
                     )
-                    row = cursor.fetchone()
+                    if result.returncode != 0:
+                        return result.returncode, "Database restore failed"
+
+                    with closing(sqlite3.connect(temp_db_path)) as db:
+                        try:
+                            row = db.execute(
+                                "SELECT code, created FROM _litestream_verification WHERE code = ? and created = ?",
+                                data,
+                            ).fetchone()
+                        except sqlite3.OperationalError:
+                            # the backup predates the verification table, not in sync yet
+                            row = None
+                    if row:
+                        return 0, "All good! Backup data is in sync"
+
+        return 1, "Oops! Backup data seems to be out of sync"
 
-        if not row:
-            return 1, "Oops! Backup data seems to be out of sync"
-        return 0, "All good! Backup data is in sync"
 
+def _replica_path(location: str | Path, prefix: Path | None) -> str:
+    name = Path(location).name
+    return str(prefix / name) if prefix else name
 
+
+@lru_cache(maxsize=None)
+def _get_yaml_dumper() -> type:
+    try:
+        from yaml import CSafeDumper as _SafeDumper
+    except ImportError:
+        from yaml import SafeDumper as _SafeDumper  # type: ignore[assignment]
+
+    class Dumper(_SafeDumper):
+        pass
+
+    # settings commonly hold paths as ``BASE_DIR / "db.sqlite3"``
+    Dumper.add_multi_representer(PurePath, lambda dumper, path: dumper.represent_str(str(path)))
+    return Dumper
+
+
+@lru_cache(maxsize=None)
 def _db_location_from_alias(alias: str) -> str:
     db_settings = settings.DATABASES.get(alias, {})
     if db_settings.get("ENGINE") == "django.db.backends.sqlite3":
@@ -341,6 +407,12 @@ def _db_location_from_alias(alias: str) -> str:
     return alias
 
 
+@receiver(setting_changed)
+def _clear_db_locations(*, setting: str, **kwargs) -> None:
+    if setting == "DATABASES":
+        _db_location_from_alias.cache_clear()
+
+
 def _add_argument(parser: ArgumentParser, args: dict) -> None:
-    copied_args = args.copy()
-    parser.add_argument(copied_args.pop("name"), **copied_args)
+    name, kwargs, _, _ = _compile_argument(args)
+    parser.add_argument(name, **kwargs)
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import logging
+import sqlite3
 
+import pytest
 from django.conf import settings
 
 pytest_plugins = []  # type: ignore
@@ -37,3 +39,17 @@ def pytest_configure(config):
         SECRET_KEY="not-a-secret",
         LITESTREAM=LITESTREAM,
     )
+
+
+@pytest.fixture(scope="session")
+def outdated_db(tmp_path_factory):
+    """A database with an empty verification table, as restored from a backup that is out of sync."""
+    path = tmp_path_factory.mktemp("verify") / "outdated.sqlite3"
+    with sqlite3.connect(path) as conn:
+        # throwaway fixture, durability does not matter
+        conn.executescript("PRAGMA journal_mode=MEMORY; PRAGMA synchronous=OFF;")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS _litestream_verification(id INTEGER PRIMARY KEY, code TEXT, created TEXT) strict;"
+        )
+        conn.commit()
+    return path
@@ -3,20 +3,39 @@ from __future__ import annotations
 import shutil
 import sqlite3
 import subprocess
+from io import StringIO
+from pathlib import Path
 from unittest.mock import patch
 
 import pytest
+import yaml
+from django.core.management import call_command
 from django.test import override_settings
-from yaml import load
-from yaml import Loader
 
 from .conftest import LITESTREAM
 from django_litestream.management.commands.litestream import Command
 
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-@pytest.fixture
-def parser():
-    return Command().create_parser("manage", "litestream")
+
+def _load_yaml(path):
+    return yaml.load(path.read_bytes(), Loader=Loader)
+
+
+def _build_config(litestream_config):
+    """Build the ``init`` config for the given ``LITESTREAM`` settings, without writing it."""
+    with override_settings(LITESTREAM=litestream_config):
+        return Command().build_config()
+
+
+@pytest.fixture(scope="session")
+def command():
+    return Command()
+
+
+@pytest.fixture(scope="session")
+def parser(command):
+    return command.create_parser("manage", "litestream")
 
 
 @pytest.fixture
@@ -27,139 +46,151 @@ def temp_config_file(tmp_path):
 config_file = LITESTREAM["config_file"]
 
 
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Nothing replicates during tests, don't let ``verify`` wait for it."""
+    monkeypatch.setattr("time.sleep", lambda _: None)
+
+
 @pytest.mark.parametrize(
     "input_args,parsed_args",
     [
-        ("databases", f"databases -config {config_file}"),
-        ("generations default", f"generations -config {config_file} db.sqlite3"),
+        (["databases"], ["databases", "-config", config_file]),
+        (["generations", "default"], ["generations", "-config", config_file, "db.sqlite3"]),
         (
-            "generations -replica s3 default",
-            f"generations -config {config_file} -replica s3 db.sqlite3",
+            ["generations", "-replica", "s3", "default"],
+            ["generations", "-config", config_file, "-replica", "s3", "db.sqlite3"],
         ),
-        ("replicate", f"replicate -config {config_file}"),
+        (["replicate"], ["replicate", "-config", config_file]),
         # (
-        #     "replicate -exec 'python manage.py runserver'",
-        #     f"replicate -config {config_file} -exec 'python manage.py runserver'",
+        #     ["replicate", "-exec", "python manage.py runserver"],
+        #     ["replicate", "-config", config_file, "-exec", "python manage.py runserver"],
         # ),
-        ("restore default", f"restore -config {config_file} db.sqlite3"),
+        (["restore", "default"], ["restore", "-config", config_file, "db.sqlite3"]),
         (
-            "restore -replica s3 -if-db-not-exists default -if-replica-exists",
-            f"restore -config {config_file} -replica s3 -if-replica-exists -if-db-not-exists db.sqlite3",
+            ["restore", "-replica", "s3", "-if-db-not-exists", "default", "-if-replica-exists"],
+            [
+                "restore",
+                "-config",
+                config_file,
+                "-replica",
+                "s3",
+                "-if-replica-exists",
+                "-if-db-not-exists",
+                "db.sqlite3",
+            ],
         ),
         (
-            "restore -replica s3 -if-db-not-exists default -if-replica-exist -o db2.sqlite2",
-            f"restore -config {config_file} -replica s3 -o db2.sqlite2 -if-replica-exists -if-db-not-exists db.sqlite3",
+            ["restore", "-replica", "s3", "-if-db-not-exists", "default", "-if-replica-exist", "-o", "db2.sqlite2"],
+            [
+                "restore",
+                "-config",
+                config_file,
+                "-replica",
+                "s3",
+                "-o",
+                "db2.sqlite2",
+                "-if-replica-exists",
+                "-if-db-not-exists",
+                "db.sqlite3",
+            ],
         ),
         (
-            "snapshots default -replica s3",
-            f"snapshots -config {config_file} -replica s3 db.sqlite3",
+            ["snapshots", "default", "-replica", "s3"],
+            ["snapshots", "-config", config_file, "-replica", "s3", "db.sqlite3"],
         ),
         (
-            "wal default -replica s3",
-            f"wal -config {config_file} -replica s3 db.sqlite3",
+            ["wal", "default", "-replica", "s3"],
+            ["wal", "-config", config_file, "-replica", "s3", "db.sqlite3"],
         ),
     ],
 )
-def test_parse_args(parser, input_args, parsed_args):
-    input_list = input_args.split(" ")
-    parsed_args_list = parsed_args.split(" ")
+def test_parse_args(command, parser, input_args, parsed_args):
+    namespace = parser.parse_args(input_args)
+    ls_args = command.parse_args(subcommand=input_args[0], options=vars(namespace))
+    assert ls_args == parsed_args
+
+
+DEFAULT_DB = {
+    "path": "db.sqlite3",
+    "replicas": [
+        {
+            "type": "s3",
+            "bucket": "$LITESTREAM_REPLICA_BUCKET",
+            "path": "db.sqlite3",
+            "access-key-id": "$LITESTREAM_ACCESS_KEY_ID",
+            "secret-access-key": "$LITESTREAM_SECRET_ACCESS_KEY",
+        }
+    ],
+}
 
-    namespace = parser.parse_args(input_list)
-    ls_args = Command().parse_args(subcommand=input_list[0], options=vars(namespace))
-    assert ls_args == parsed_args_list
+OTHER_DB = {
+    "path": "db2.sqlite3",
+    "replicas": [
+        {
+            "type": "s3",
+            "bucket": "bucket",
+            "path": "db2.sqlite3",
+            "access-key-id": "access-key",
+            "secret-access": "secret",
+        }
+    ],
+}
 
 
 def test_init(temp_config_file):
     Command().init(temp_config_file)
-    with open(temp_config_file) as f:
-        config = load(f, Loader=Loader)
-
-    assert config == {
-        "dbs": [
-            {
-                "path": "db.sqlite3",
-                "replicas": [
-                    {
-                        "type": "s3",
-                        "bucket": "$LITESTREAM_REPLICA_BUCKET",
-                        "path": "db.sqlite3",
-                        "access-key-id": "$LITESTREAM_ACCESS_KEY_ID",
-                        "secret-access-key": "$LITESTREAM_SECRET_ACCESS_KEY",
-                    }
-                ],
-            }
-        ]
-    }
+    config = _load_yaml(temp_config_file)
+
+    assert config == {"dbs": [DEFAULT_DB]}
 
 
-def test_init_override_db(temp_config_file):
+@pytest.mark.parametrize(
+    "litestream_config,dbs",
+    [
+        ({}, [DEFAULT_DB]),
+        ({"dbs": [OTHER_DB]}, [OTHER_DB]),
+        ({"extend_dbs": [OTHER_DB]}, [DEFAULT_DB, OTHER_DB]),
+    ],
+    ids=["default", "override_dbs", "extend_dbs"],
+)
+def test_init_dbs(litestream_config, dbs):
+    config = _build_config(litestream_config)
+
+    assert config == {"dbs": dbs}
+
+
+def test_init_path_prefix():
+    config = _build_config({"path_prefix": "myproject"})
+
+    assert config["dbs"][0]["replicas"][0]["path"] == "myproject/db.sqlite3"
+
+
+def test_init_path_values(temp_config_file, tmp_path):
     litestream_config = {
         "config_file": temp_config_file,
-        "dbs": [
-            {
-                "path": "db2.sqlite3",
-                "replicas": [
-                    {
-                        "type": "s3",
-                        "bucket": "bucket",
-                        "path": "db2.sqlite3",
-                        "access-key-id": "access-key",
-                        "secret-access": "secret",
-                    }
-                ],
-            }
-        ],
+        "dbs": [{"path": tmp_path / "db2.sqlite3"}],
     }
     with override_settings(LITESTREAM=litestream_config):
         Command().init(temp_config_file)
-        with open(temp_config_file) as f:
-            config = load(f, Loader=Loader)
+    config = _load_yaml(temp_config_file)
 
-    assert config == {"dbs": litestream_config["dbs"]}
+    assert config == {"dbs": [{"path": str(tmp_path / "db2.sqlite3")}]}
 
 
-def test_init_extend_dbs(temp_config_file):
+def test_init_litestream_settings():
     litestream_config = {
-        "config_file": temp_config_file,
-        "extend_dbs": [
-            {
-                "path": "db2.sqlite3",
-                "replicas": [
-                    {
-                        "type": "s3",
-                        "bucket": "bucket",
-                        "path": "db2.sqlite3",
-                        "access-key-id": "access-key",
-                        "secret-access": "secret",
-                    }
-                ],
-            }
-        ],
-    }
-    with override_settings(LITESTREAM=litestream_config):
-        Command().init(temp_config_file)
-        with open(temp_config_file) as f:
-            config = load(f, Loader=Loader)
-
-    assert config == {
-        "dbs": [
-            {
-                "path": "db.sqlite3",
-                "replicas": [
-                    {
-                        "type": "s3",
-                        "bucket": "$LITESTREAM_REPLICA_BUCKET",
-                        "path": "db.sqlite3",
-                        "access-key-id": "$LITESTREAM_ACCESS_KEY_ID",
-                        "secret-access-key": "$LITESTREAM_SECRET_ACCESS_KEY",
-                    }
-                ],
-            },
-            litestream_config["extend_dbs"][0],
-        ]
+        "dbs": [{"path": "db.sqlite3"}],
+        "addr": ":9090",
+        "logging": {},
+        "access-key-id": "access-key",
     }
+    config = _build_config(litestream_config)
+
+    assert config == {"dbs": [{"path": "db.sqlite3"}], "addr": ":9090"}
 
 
+@pytest.mark.usefixtures("no_sleep")
 def test_verify(tmp_path):
     sqlite_db = tmp_path / "db.sqlite3"
 
@@ -167,24 +198,130 @@ def test_verify(tmp_path):
         shutil.copy(sqlite_db, args[0][5])
         return subprocess.CompletedProcess(args, 0)
 
-    with patch("time.sleep", side_effect=lambda _: _), patch("subprocess.run", side_effect=mock_subprocess_run):
+    with patch("subprocess.run", side_effect=mock_subprocess_run):
         exit_code, msg = Command().verify(sqlite_db, config=config_file)
         assert exit_code == 0
 
 
-def test_verify_fails(tmp_path):
+@pytest.mark.usefixtures("no_sleep")
+def test_verify_fails(tmp_path, outdated_db):
     sqlite_db = tmp_path / "db.sqlite3"
-    outdated_db = tmp_path / "outdated.sqlite3"
-    with sqlite3.connect(outdated_db) as conn:
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS _litestream_verification(id INTEGER PRIMARY KEY, code TEXT, created TEXT) strict;"
-        )
-        conn.commit()
 
     def mock_subprocess_run(*args, **kwargs):
         shutil.copy(outdated_db, args[0][5])
         return subprocess.CompletedProcess(args, 0)
 
-    with patch("time.sleep", side_effect=lambda _: _), patch("subprocess.run", side_effect=mock_subprocess_run):
+    with patch("subprocess.run", side_effect=mock_subprocess_run):
         exit_code, msg = Command().verify(sqlite_db, config=config_file)
         assert exit_code == 1
+
+
+@pytest.mark.usefixtures("no_sleep")
+def test_verify_retries_until_in_sync(tmp_path, outdated_db):
+    sqlite_db = tmp_path / "db.sqlite3"
+    calls = []
+
+    def mock_subprocess_run(*args, **kwargs):
+        restored_db = args[0][5]
+        # the previous attempt's copy is removed before restoring again
+        assert list(restored_db.parent.glob("*.restored")) == []
+        calls.append(args)
+        shutil.copy(outdated_db if len(calls) == 1 else sqlite_db, restored_db)
+        return subprocess.CompletedProcess(args, 0)
+
+    with patch("subprocess.run", side_effect=mock_subprocess_run):
+        exit_code, msg = Command().verify(sqlite_db, config=config_file)
+        assert exit_code == 0
+        assert len(calls) == 2
+
+
+@pytest.mark.usefixtures("no_sleep")
+def test_verify_retries_without_verification_table(tmp_path):
+    sqlite_db = tmp_path / "db.sqlite3"
+    older_db = tmp_path / "older.sqlite3"
+    with sqlite3.connect(older_db) as conn:
+        conn.execute("CREATE TABLE other(id INTEGER PRIMARY KEY)")
+    calls = []
+
+    def mock_subprocess_run(*args, **kwargs):
+        calls.append(args)
+        shutil.copy(older_db if len(calls) == 1 else sqlite_db, args[0][5])
+        return subprocess.CompletedProcess(args, 0)
+
+    with patch("subprocess.run", side_effect=mock_subprocess_run):
+        exit_code, msg = Command().verify(sqlite_db, config=config_file)
+        assert exit_code == 0
+        assert len(calls) == 2
+
+
+@pytest.mark.usefixtures("no_sleep")
+def test_verify_restore_failed(tmp_path):
+    sqlite_db = tmp_path / "db.sqlite3"
+    calls = []
+
+    def mock_subprocess_run(*args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 2)
+
+    with patch("subprocess.run", side_effect=mock_subprocess_run):
+        exit_code, msg = Command().verify(sqlite_db, config=config_file)
+        assert (exit_code, msg) == (2, "Database restore failed")
+        assert len(calls) == 1
+
+
+@pytest.mark.parametrize(
+    "argv,ls_args",
+    [
+        (["databases"], ["databases", "-config", config_file]),
+        (["version"], ["version"]),
+    ],
+)
+def test_run_litestream_from_command_line_execs(argv, ls_args):
+    command = Command()
+    bin_path = Path("/usr/bin/litestream")
+    events = []
+    stdout_flush = patch.object(command.stdout, "flush", side_effect=lambda: events.append("flush stdout"))
+    stderr_flush = patch.object(command.stderr, "flush", side_effect=lambda: events.append("flush stderr"))
+    execvp = patch("os.execvp", side_effect=lambda *args: events.append(("execvp", *args)))
+    litestream_settings = override_settings(LITESTREAM={**LITESTREAM, "bin_path": bin_path})
+    posix = patch("os.name", "posix")
+    with litestream_settings, posix, stdout_flush, stderr_flush, execvp, patch("subprocess.run") as run:
+        command.run_from_argv(["manage.py", "litestream", "--skip-checks", *argv])
+
+    cmd = [str(bin_path), *ls_args]
+    assert events == ["flush stdout", "flush stderr", ("execvp", cmd[0], cmd)]
+    run.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "argv,ls_args",
+    [
+        (["databases"], ["databases", "-config", config_file]),
+        (["version"], ["version"]),
+    ],
+)
+def test_run_litestream_call_command_uses_subprocess(argv, ls_args):
+    with patch("os.execvp") as execvp, patch("subprocess.run") as run:
+        call_command(Command(), *argv)
+
+    execvp.assert_not_called()
+    run.assert_called_once_with(["litestream", *ls_args], check=False)
+
+
+def test_run_litestream_non_posix_uses_subprocess():
+    command = Command()
+    command._exec_binary = True
+    with patch("os.name", "nt"), patch("os.execvp") as execvp, patch("subprocess.run") as run:
+        command.run_litestream(["version"])
+
+    execvp.assert_not_called()
+    run.assert_called_once_with(["litestream", "version"], check=False)
+
+
+def test_run_litestream_interrupted():
+    stdout = StringIO()
+    with patch("os.execvp") as execvp, patch("subprocess.run", side_effect=KeyboardInterrupt):
+        call_command(Command(), "replicate", stdout=stdout)
+
+    execvp.assert_not_called()
+    assert "Litestream command interrupted" in stdout.getvalue()